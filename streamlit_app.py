@@ -1,10 +1,17 @@
 import streamlit as st
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import datetime
-import json
+import os
+import pickle
+from concurrent.futures import ThreadPoolExecutor
+from itertools import groupby
+from operator import itemgetter
+import ijson
 import pandas as pd
 import numpy as np
-from pycountry import countries
 
 # --- CONFIGURATION & CONSTANTS ---
 # Fetch the key securely from the secrets file (or set a placeholder if not found)
@@ -13,9 +20,12 @@ try:
 except KeyError:
     OWM_API_KEY = "PLACEHOLDER_FOR_SECRETS_NOT_LOADED" 
 
-CURRENT_WEATHER_URL = "http://api.openweathermap.org/data/2.5/weather"
-FORECAST_URL = "http://api.openweathermap.org/data/2.5/forecast"
+CURRENT_WEATHER_URL = "https://api.openweathermap.org/data/2.5/weather"
+FORECAST_URL = "https://api.openweathermap.org/data/2.5/forecast"
+REQUEST_TIMEOUT = (3, 5)  # (connect, read) seconds
 CITY_LIST_FILE = "city.list.json" 
+CITY_CACHE_FILE = "city_cache.pkl"  # Pickled result of processing CITY_LIST_FILE
+CITY_CACHE_VERSION = 2  # Bump whenever the processing or the returned tuple changes
 UNITS = "metric"  
 
 # Emoji mapping based on OpenWeatherMap 'main' weather group
@@ -62,38 +72,110 @@ CARD_STYLES = {
     # Default (Light background, dark font)
     "Default": f"{BASE_CARD_CSS} background-color: #F5F5F5; border-left: 5px solid #696969; color: #333333;",
 }
+
+# Positional view of CARD_STYLES: each forecast row stores a small style index
+# so the render loop picks its CSS with a tuple index.
+CARD_STYLE_INDEX = {condition: i for i, condition in enumerate(CARD_STYLES)}
+CARD_STYLE_TUPLE = tuple(CARD_STYLES.values())
+DEFAULT_STYLE_INDEX = CARD_STYLE_INDEX["Default"]
+
+# Shared HTML template for the hourly forecast cards. The card's own style (from
+# CARD_STYLES) already carries BASE_CARD_CSS, so a single div is enough; the font 
+# color is set by 'color: inherit' and controlled by that style.
+CARD_TEMPLATE = (
+    '<div style="{style}">'
+    '<h5 style="margin-top: 0; margin-bottom: 5px; color: inherit;">{Time}</h5>'
+    '<p style="font-size: 1.0em; margin-bottom: 5px; color: inherit;">'
+    '<b>{ConditionEmoji} {ConditionDescription}</b>'
+    '</p>'
+    '<p style="margin: 3px 0; font-size: 0.9em; color: inherit;">'
+    '🌡️ <b>{Temp:.1f}°C</b> (Feels: {FeelsLike:.1f}°C)'
+    '</p>'
+    '<p style="margin: 3px 0; font-size: 0.9em; color: inherit;">'
+    '💧 Humidity: {Humidity:.0f}%'
+    '</p>'
+    '<p style="margin: 3px 0; font-size: 0.9em; color: inherit;">'
+    '💨 Wind: {WindSpeed:.1f} m/s {WindDir}'
+    '</p>'
+    '</div>'
+)
+# Day layout: cards fill left-to-right, as many per row as fit, and stack on narrow screens
+FORECAST_GRID_CSS = "display: grid; grid-template-columns: repeat(auto-fill, minmax(220px, 1fr)); gap: 10px;"
 # --- END OF CONSTANTS ---
 
 # --- DATA LOADING AND CACHING ---
 
-def get_country_name(code):
-    """Helper function to convert Alpha-2 code to full country name."""
-    try:
-        return countries.get(alpha_2=code).name
-    except AttributeError:
-        return code
+def get_country_code_map():
+    """Builds the Alpha-2 code to full country name lookup."""
+    # Imported lazily: pycountry loads its ISO database on import, and this is only
+    # needed when the city cache has to be rebuilt.
+    from pycountry import countries
+    return {c.alpha_2: c.name for c in countries}
 
-@st.cache_data(show_spinner="Loading and processing 200,000+ cities... This may take a moment.")
+@st.cache_resource(show_spinner="Loading and processing 200,000+ cities... This may take a moment.")
 def load_and_process_city_data():
     """
-    Loads the massive OWM city list, processes it into a DataFrame,
-    and prepares country name mappings.
+    Loads the massive OWM city list and prepares the country name mappings
+    and per-country city lists used by the sidebar.
     """
     try:
-        with open(CITY_LIST_FILE, 'r', encoding='utf-8') as f:
-            data = json.load(f)
+        # Reuse the pickled result when it was written by the current CITY_CACHE_VERSION
+        # and is at least as new as the raw JSON (or the JSON is absent), skipping the
+        # JSON parse, the country-name mapping and the derived lookups.
+        # NOTE: pickle.load executes whatever the file contains. The cache is only ever
+        # written by this app into its own working directory; never ship or accept a
+        # city_cache.pkl from elsewhere.
+        if (os.path.exists(CITY_CACHE_FILE)
+                and (not os.path.exists(CITY_LIST_FILE)
+                     or os.path.getmtime(CITY_CACHE_FILE) >= os.path.getmtime(CITY_LIST_FILE))):
+            try:
+                with open(CITY_CACHE_FILE, 'rb') as f:
+                    version, cached = pickle.load(f)
+                if version == CITY_CACHE_VERSION and isinstance(cached, tuple) and len(cached) == 4:
+                    return cached
+            except Exception:
+                pass  # Unreadable or incompatible cache: rebuild it from the JSON below
+        
+        # Stream the array item-by-item and keep only the two fields we need,
+        # instead of materialising every city dict in memory first.
+        names = []
+        codes = []
+        with open(CITY_LIST_FILE, 'rb') as f:
+            for obj in ijson.items(f, 'item'):
+                name = obj.get('name')
+                code = obj.get('country')
+                if name is None or code is None:
+                    continue
+                names.append(name)
+                codes.append(code)
         
-        df = pd.DataFrame(data)
-        df = df[['name', 'country']].rename(columns={'name': 'City', 'country': 'CountryCode'})
-        df.dropna(subset=['City', 'CountryCode'], inplace=True)
+        df = pd.DataFrame({'City': names, 'CountryCode': codes})
         
-        df['CountryName'] = df['CountryCode'].apply(get_country_name)
+        # Map Alpha-2 codes to full country names in one vectorized pass;
+        # unknown codes fall back to the code itself.
+        code_to_name = get_country_code_map()
+        df['CountryName'] = df['CountryCode'].map(code_to_name).fillna(df['CountryCode'])
         
-        country_map = {name: code for name, code in zip(df['CountryName'], df['CountryCode'])}
-        sorted_country_names = sorted(df['CountryName'].unique())
+        country_pairs = df[['CountryName', 'CountryCode']].drop_duplicates(keep='last')
+        country_map = dict(zip(country_pairs['CountryName'], country_pairs['CountryCode']))
+        sorted_country_names = sorted(country_pairs['CountryName'].unique())
+        default_country_idx = sorted_country_names.index("United States") if "United States" in sorted_country_names else 0
+        
+        # Precompute the sorted city list per country so reruns only need a dict lookup
+        country_to_cities = {
+            name: sorted(set(cities))
+            for name, cities in df.groupby('CountryName', sort=False, observed=True)['City']
+        }
+        
+        result = (sorted_country_names, default_country_idx, country_map, country_to_cities)
+        try:
+            with open(CITY_CACHE_FILE, 'wb') as f:
+                pickle.dump((CITY_CACHE_VERSION, result), f, protocol=5)
+        except OSError:
+            pass  # Read-only deployments simply re-parse on the next cold start
         
         st.success("City list loaded and country names mapped successfully!")
-        return df, sorted_country_names, country_map
+        return result
     
     except FileNotFoundError:
         st.error(f"⚠️ Error: The file '{CITY_LIST_FILE}' was not found. Please download it and save it.")
@@ -104,6 +186,10 @@ def load_and_process_city_data():
 
 # --- HELPER FUNCTIONS ---
 
+def get_local_timezone(timezone_offset):
+    """Builds a fixed-offset timezone from the OWM 'timezone' shift (seconds from UTC)."""
+    return datetime.timezone(datetime.timedelta(seconds=timezone_offset))
+
 def convert_timestamp_to_local(timestamp_utc, timezone_offset):
     """
     Converts a UTC Unix timestamp to a local datetime object using the timezone offset.
@@ -112,11 +198,7 @@ def convert_timestamp_to_local(timestamp_utc, timezone_offset):
     if timestamp_utc is None or timezone_offset is None:
         return None
         
-    dt_utc = datetime.datetime.utcfromtimestamp(timestamp_utc)
-    offset = datetime.timedelta(seconds=timezone_offset)
-    dt_local = dt_utc + offset
-    
-    return dt_local
+    return datetime.datetime.fromtimestamp(timestamp_utc, get_local_timezone(timezone_offset))
 
 def get_wind_direction(deg):
     """Converts wind degrees (0-360) to a cardinal direction."""
@@ -129,6 +211,33 @@ def get_wind_direction(deg):
 
 # --- API FETCH LOGIC ---
 
+@st.cache_resource(show_spinner=False)
+def get_session():
+    """
+    Returns the process-wide HTTP session so the current weather and forecast calls
+    reuse pooled HTTPS connections across reruns and sessions. Transient gateway
+    errors are retried with a short backoff instead of surfacing to the user.
+    """
+    session = requests.Session()
+    session.mount("https://", HTTPAdapter(
+        pool_connections=4,
+        pool_maxsize=4,
+        # Only gateway errors are retried (plus one reconnect), never read timeouts, and
+        # a server Retry-After header is ignored in favour of the short backoff, so each
+        # attempt is capped by REQUEST_TIMEOUT and the pauses between attempts stay sub-second.
+        max_retries=Retry(
+            total=2,
+            connect=1,
+            read=0,
+            status=2,
+            backoff_factor=0.3,
+            status_forcelist=[502, 503, 504],
+            raise_on_status=False,
+            respect_retry_after_header=False,
+        ),
+    ))
+    return session
+
 def handle_api_error():
     """Checks for API key setup."""
     if OWM_API_KEY == "PLACEHOLDER_FOR_SECRETS_NOT_LOADED":
@@ -137,51 +246,60 @@ def handle_api_error():
         return True
     return False
 
+# Successful responses are cached; failures raise out of the cached functions so they are never stored.
+@st.cache_data(ttl=600, show_spinner=False)
+def fetch_current_weather(city_name, country_code):
+    """Requests current weather JSON from OWM, raising on HTTP/connection errors."""
+    query = f"{city_name},{country_code}"
+    params = {'q': query, 'appid': OWM_API_KEY, 'units': UNITS}
+    
+    response = get_session().get(CURRENT_WEATHER_URL, params=params, timeout=REQUEST_TIMEOUT)
+    response.raise_for_status() 
+    return response.json()
+
+@st.cache_data(ttl=1800, show_spinner=False)
+def fetch_forecast(city_name, country_code):
+    """Requests 5-day / 3-hour forecast JSON from OWM, raising on HTTP/connection errors."""
+    query = f"{city_name},{country_code}"
+    params = {'q': query, 'appid': OWM_API_KEY, 'units': UNITS}
+
+    response = get_session().get(FORECAST_URL, params=params, timeout=REQUEST_TIMEOUT)
+    response.raise_for_status() 
+    return response.json()
+
+# The get_* functions run on worker threads, so they return (data, error) instead of
+# writing to the page; error is a (level, message) pair rendered by show_api_error().
 def get_current_weather_data(city_name, country_code):
-    """Fetches current weather data."""
-    if handle_api_error():
-        return None
-        
+    """Fetches current weather data. Returns (data, None) on success or (None, (level, message)) on failure."""
     try:
-        query = f"{city_name},{country_code}"
-        params = {'q': query, 'appid': OWM_API_KEY, 'units': UNITS}
-        
-        response = requests.get(CURRENT_WEATHER_URL, params=params)
-        response.raise_for_status() 
-        return response.json()
+        return fetch_current_weather(city_name, country_code), None
 
     except requests.exceptions.HTTPError as err:
-        if response.status_code == 404:
-            st.error(f"City '{city_name}' not found for current weather. Please select another city.")
-        else:
-            st.error(f"HTTP Error fetching current weather: {err}")
-        return None
+        if err.response is not None and err.response.status_code == 404:
+            return None, ("error", f"City '{city_name}' not found for current weather. Please select another city.")
+        return None, ("error", f"HTTP Error fetching current weather: {err}")
     except requests.exceptions.RequestException as e:
-        st.error(f"Error connecting to OWM API for current weather: {e}")
-        return None
+        return None, ("error", f"Error connecting to OWM API for current weather: {e}")
 
 def get_forecast_data(city_name, country_code):
-    """Fetches 5-day / 3-hour forecast data."""
-    if handle_api_error():
-        return None
-
+    """Fetches 5-day / 3-hour forecast data. Returns (data, None) on success or (None, (level, message)) on failure."""
     try:
-        query = f"{city_name},{country_code}"
-        params = {'q': query, 'appid': OWM_API_KEY, 'units': UNITS}
-
-        response = requests.get(FORECAST_URL, params=params)
-        response.raise_for_status() 
-        return response.json()
+        return fetch_forecast(city_name, country_code), None
 
     except requests.exceptions.HTTPError as err:
-        if response.status_code == 404:
-            st.warning("Forecast data not available for this specific city.")
-        else:
-            st.error(f"HTTP Error fetching forecast: {err}")
-        return None
+        if err.response is not None and err.response.status_code == 404:
+            return None, ("warning", "Forecast data not available for this specific city.")
+        return None, ("error", f"HTTP Error fetching forecast: {err}")
     except requests.exceptions.RequestException as e:
-        st.error(f"Error connecting to OWM API for forecast: {e}")
-        return None
+        return None, ("error", f"Error connecting to OWM API for forecast: {e}")
+
+def show_api_error(error):
+    """Renders a (level, message) error returned by the get_* fetch functions."""
+    level, message = error
+    if level == "warning":
+        st.warning(message)
+    else:
+        st.error(message)
 
 
 # --- DISPLAY LOGIC ---
@@ -282,10 +400,13 @@ def display_forecast(data, timezone_offset):
 
     forecast_rows = []
     
+    # Resolve the location's timezone once and convert each timestamp with a single C-level call
+    local_tz = get_local_timezone(timezone_offset)
+    
     for item in forecast_list:
         dt_utc = item.get('dt')
-        dt_local = convert_timestamp_to_local(dt_utc, timezone_offset)
-        if dt_local is None: continue
+        if dt_utc is None: continue
+        dt_local = datetime.datetime.fromtimestamp(dt_utc, local_tz)
 
         main = item.get('main', {})
         weather = item.get('weather', [{}])[0]
@@ -293,9 +414,9 @@ def display_forecast(data, timezone_offset):
         
         main_weather_group = weather.get('main', 'N/A')
         
-        row = {
+        forecast_rows.append({
             "Time": dt_local.strftime('%H:%M'),
-            "MainCondition": main_weather_group,
+            "StyleIdx": CARD_STYLE_INDEX.get(main_weather_group, DEFAULT_STYLE_INDEX),
             "ConditionEmoji": WEATHER_EMOJIS.get(main_weather_group, '❓'),
             "ConditionDescription": weather.get('description', 'N/A').capitalize(),
             "Temp": main.get('temp', np.nan),
@@ -304,15 +425,15 @@ def display_forecast(data, timezone_offset):
             "WindSpeed": wind.get('speed', np.nan),
             "WindDeg": wind.get('deg', np.nan),
             "FilterDate": dt_local.date()
-        }
-        forecast_rows.append(row)
-
-    df_forecast = pd.DataFrame(forecast_rows)
+        })
     
-    unique_dates = df_forecast['FilterDate'].unique()
+    # The rows are only ever formatted one card at a time, so group the plain dicts
+    # by day directly instead of going through a DataFrame.
+    forecast_rows.sort(key=itemgetter('FilterDate'))
+    day_groups = [(date, list(rows)) for date, rows in groupby(forecast_rows, key=itemgetter('FilterDate'))]
     
     tab_titles = []
-    for i, date in enumerate(unique_dates):
+    for i, (date, _) in enumerate(day_groups):
         if i == 0:
             title = "Today"
         elif i == 1:
@@ -323,61 +444,28 @@ def display_forecast(data, timezone_offset):
         
     tabs = st.tabs(tab_titles)
     
-    # Layout Fix: 4 cards per row
-    cols_per_row = 4 
-    
-    for i, date in enumerate(unique_dates):
+    for i, (date, day_rows) in enumerate(day_groups):
         with tabs[i]:
             st.markdown(f"### Hourly Forecast for {tab_titles[i]}")
             
-            # Filter the DataFrame for the current day
-            df_day = df_forecast[df_forecast['FilterDate'] == date].copy()
-            
-            # FIX: Process the cards sequentially in chunks of 4 to ensure left-to-right order.
-            num_cards = len(df_day)
-            num_rows = (num_cards + cols_per_row - 1) // cols_per_row
-            
-            for row_idx in range(num_rows):
-                # Create a new set of columns for each row
-                current_cols = st.columns(cols_per_row)
-                
-                # Process the 4 cards (or fewer for the last row)
-                start_card_index = row_idx * cols_per_row
-                end_card_index = min(start_card_index + cols_per_row, num_cards)
-                
-                for col_offset, internal_idx in enumerate(range(start_card_index, end_card_index)):
-                    
-                    hour_data = df_day.iloc[internal_idx] # Access data by internal numerical index
-                    
-                    # Determine the style based on the main weather condition
-                    style = CARD_STYLES.get(hour_data['MainCondition'], CARD_STYLES["Default"])
-                    wind_dir = get_wind_direction(hour_data['WindDeg'])
-                    
-                    # --- HTML/CSS Card Generation ---
-                    # The font color is set by the 'color: inherit' and controlled by the 
-                    # main style property in CARD_STYLES.
-                    html_card = f"""
-                    <div style="padding: 15px; border-radius: 10px; box-shadow: 0 4px 8px rgba(0, 0, 0, 0.1); {style}">
-                        <h5 style="margin-top: 0; margin-bottom: 5px; color: inherit;">{hour_data['Time']}</h5>
-                        <p style="font-size: 1.0em; margin-bottom: 5px; color: inherit;">
-                            <b>{hour_data['ConditionEmoji']} {hour_data['ConditionDescription']}</b>
-                        </p>
-                        <p style="margin: 3px 0; font-size: 0.9em; color: inherit;">
-                            🌡️ <b>{hour_data['Temp']:.1f}°C</b> (Feels: {hour_data['FeelsLike']:.1f}°C)
-                        </p>
-                        <p style="margin: 3px 0; font-size: 0.9em; color: inherit;">
-                            💧 Humidity: {hour_data['Humidity']:.0f}%
-                        </p>
-                        <p style="margin: 3px 0; font-size: 0.9em; color: inherit;">
-                            💨 Wind: {hour_data['WindSpeed']:.1f} m/s {wind_dir}
-                        </p>
-                    </div>
-                    """
-                    
-                    # Place the raw HTML into the current column
-                    with current_cols[col_offset]:
-                        st.markdown(html_card, unsafe_allow_html=True)
-                        st.markdown("", unsafe_allow_html=True) 
+            # Build the whole day as one CSS grid (4 cards per row, filled left-to-right)
+            # so each tab costs a single markdown element instead of one per card.
+            cards_html = "".join(
+                CARD_TEMPLATE.format(
+                    # Style resolved from the main weather condition when the row was built
+                    style=CARD_STYLE_TUPLE[hour_data['StyleIdx']],
+                    Time=hour_data['Time'],
+                    ConditionEmoji=hour_data['ConditionEmoji'],
+                    ConditionDescription=hour_data['ConditionDescription'],
+                    Temp=hour_data['Temp'],
+                    FeelsLike=hour_data['FeelsLike'],
+                    Humidity=hour_data['Humidity'],
+                    WindSpeed=hour_data['WindSpeed'],
+                    WindDir=get_wind_direction(hour_data['WindDeg']),
+                )
+                for hour_data in day_rows
+            )
+            st.markdown(f'<div style="{FORECAST_GRID_CSS}">{cards_html}</div>', unsafe_allow_html=True)
 
 
 # --- STREAMLIT APP LAYOUT (main function) ---
@@ -387,8 +475,8 @@ def main():
     st.title("Local Weather App with OWM Forecast 🗺️")
     st.markdown("---")
 
-    # Load the city data, sorted country names, and the mapping dict
-    city_df, sorted_country_names, country_map = load_and_process_city_data()
+    # Load the sorted country names (and default selection), the mapping dict, and the per-country city lists
+    sorted_country_names, default_country_idx, country_map, country_to_cities = load_and_process_city_data()
     
     # --- Sidebar/Input Area ---
     st.sidebar.header("Select Location")
@@ -397,7 +485,7 @@ def main():
     selected_country_name = st.sidebar.selectbox(
         "Select Country",
         sorted_country_names,
-        index=sorted_country_names.index("United States") if "United States" in sorted_country_names else 0,
+        index=default_country_idx,
         key="country_name_select"
     )
     
@@ -405,9 +493,7 @@ def main():
     selected_country_code = country_map.get(selected_country_name, "US")
     
     # 2. Filter Cities
-    filtered_cities_df = city_df[city_df['CountryName'] == selected_country_name]
-    city_names = filtered_cities_df['City'].unique().tolist()
-    city_names.sort()
+    city_names = country_to_cities.get(selected_country_name, [])
 
     # 3. City Selection
     st.sidebar.markdown(f"***Select City in {selected_country_name} ({len(city_names)} cities listed)***")
@@ -427,9 +513,23 @@ def main():
     # --- Main Content Area ---
     
     if fetch_button and selected_city_name:
+        if handle_api_error():
+            return
+
         with st.spinner(f"Getting data for {selected_city_name}, {selected_country_name}..."):
             
-            current_weather_data = get_current_weather_data(selected_city_name, selected_country_code)
+            # Fetch current weather and forecast concurrently. The worker threads are
+            # attached to this script run for the cached fetch functions; any errors are
+            # returned and rendered here on the script thread.
+            ctx = get_script_run_ctx()
+            with ThreadPoolExecutor(max_workers=2, initializer=add_script_run_ctx, initargs=(None, ctx)) as ex:
+                current_future = ex.submit(get_current_weather_data, selected_city_name, selected_country_code)
+                forecast_future = ex.submit(get_forecast_data, selected_city_name, selected_country_code)
+                current_weather_data, current_error = current_future.result()
+                forecast_data, forecast_error = forecast_future.result()
+            
+            if current_error:
+                show_api_error(current_error)
             
             if current_weather_data:
                 # Display Current Weather and Extended Metrics
@@ -437,8 +537,9 @@ def main():
                 
                 st.header("5-Day Forecast: Hourly Breakdown 🗓️")
                 
-                # Fetch and Display Forecast
-                forecast_data = get_forecast_data(selected_city_name, selected_country_code)
+                # Display Forecast
+                if forecast_error:
+                    show_api_error(forecast_error)
                 if forecast_data:
                     timezone_offset = current_weather_data.get('timezone', 0)
                     display_forecast(forecast_data, timezone_offset)